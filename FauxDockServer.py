@@ -7,13 +7,17 @@
 # Jan-2020, Pat Welch, pat@mousebrains.com
 
 import socket
+import os
+import stat
 import threading
 import argparse
 import logging
-import select
+import selectors
 import random
+from Poller import Poller
 
 fauxDS = None
+chunkSize = 65536 # Maximum number of bytes to read at a time
 
 def addArgs(parser:argparse.ArgumentParser) -> None:
     ''' Add my command line arguments '''
@@ -69,59 +73,81 @@ class FauxDS(threading.Thread):
         ifn = args.dsInput
         ofn = args.dsOutput
 
-        ifp = None if ifn is None else open(ifn, 'rb')
-        ofp = open(ofn, 'wb')
+        self.conn = conn
+        self.ifp = None if ifn is None else open(ifn, 'rb', buffering=0) # Raw, no read-ahead
+        self.ofp = open(ofn, 'wb')
 
         logging.info('FauxDS opened %s for input', args.dsInput)
         logging.info('FauxDS opened %s for output', args.dsOutput)
 
-        toSocket = bytearray()
-        toFile = bytearray()
-
-        while (conn is not None) or len(toFile):
-            inputs = []
-            outputs = []
-
-            if conn is not None:
-                inputs.append(conn)
-                if len(toSocket):
-                    outputs.append(conn)
-
-            if ifp is not None:
-                inputs.append(ifp)
-
-            if (ofp is not None) and len(toFile):
-                outputs.append(ofp)
-
-            (ifps, ofps, efps) = select.select(inputs, outputs, [])
-
-            for fp in ifps:
-                if fp == ifp: # File input
-                    c = fp.read(1)
-                    if c == b'': # EOF
-                        ifp.close()
-                        ifp = None
-                        logging.info('FauxDS closed %s', ifn)
-                    else:
-                        toSocket += c
-                else:
-                    c = fp.recv(1)
-                    if c == b'': # EOF
-                        conn.close()
-                        conn = None
-                        logging.info('FauxDS closed connection')
-                    else:
-                        toFile += c
-
-            for fp in ofps:
-                if fp == ofp:
-                    n = ofp.write(toFile)
-                    ofp.flush()
-                    toFile = toFile[n:]
-                else:
-                    n = conn.send(toSocket)
-                    toSocket = toSocket[n:]
-
-        if ofp is not None:
-            ofp.close()
-            logging.info('FauxDS closed %s', ofn)
+        self.toSocket = bytearray()
+        self.toFile = bytearray()
+        self.iSocket = 0 # Bytes of toSocket already sent
+        self.iFile = 0 # Bytes of toFile already written
+        self.scratch = memoryview(bytearray(chunkSize)) # Reused for every read
+
+        # A regular input file is copied to the socket by the kernel with sendfile
+        self.qSendfile = (self.ifp is not None) and stat.S_ISREG(os.fstat(self.ifp.fileno()).st_mode)
+        self.offset = 0 # Next byte of the input file to sendfile
+
+        poller = Poller()
+        self.poller = poller
+        connFD = conn.fileno()
+        ofpFD = self.ofp.fileno()
+        poller.register(connFD, selectors.EVENT_READ, self.__socketReady)
+        poller.register(ofpFD, 0, self.__fileWritable)
+        if (self.ifp is not None) and not self.qSendfile:
+            poller.register(self.ifp.fileno(), selectors.EVENT_READ, self.__fileReadable)
+
+        while (self.conn is not None) or (len(self.toFile) > self.iFile):
+            if self.conn is not None:
+                qOut = (len(self.toSocket) > self.iSocket) \
+                        or (self.qSendfile and (self.ifp is not None))
+                poller.modify(connFD, selectors.EVENT_READ | (selectors.EVENT_WRITE if qOut else 0))
+            poller.modify(ofpFD, selectors.EVENT_WRITE if len(self.toFile) > self.iFile else 0)
+            poller.dispatch()
+
+        poller.close()
+        self.ofp.close()
+        logging.info('FauxDS closed %s', ofn)
+
+    def __fileReadable(self, events:int) -> None:
+        n = self.ifp.readinto(self.scratch)
+        if not n: # EOF
+            self.poller.unregister(self.ifp.fileno())
+            self.ifp.close()
+            self.ifp = None
+            logging.info('FauxDS closed %s', self.args.dsInput)
+        else:
+            self.toSocket += self.scratch[:n]
+
+    def __fileWritable(self, events:int) -> None:
+        self.iFile += self.ofp.write(memoryview(self.toFile)[self.iFile:])
+        self.ofp.flush()
+        if (self.iFile > chunkSize) or (self.iFile > (len(self.toFile) // 2)):
+            del self.toFile[:self.iFile] # Only compact once enough has been consumed
+            self.iFile = 0
+
+    def __socketReady(self, events:int) -> None:
+        if (events & selectors.EVENT_WRITE) and self.qSendfile and (self.ifp is not None):
+            n = os.sendfile(self.conn.fileno(), self.ifp.fileno(), self.offset, chunkSize)
+            if not n: # EOF
+                self.ifp.close()
+                self.ifp = None
+                logging.info('FauxDS closed %s', self.args.dsInput)
+            self.offset += n
+        elif events & selectors.EVENT_WRITE:
+            self.iSocket += self.conn.send(memoryview(self.toSocket)[self.iSocket:])
+            if (self.iSocket > chunkSize) or (self.iSocket > (len(self.toSocket) // 2)):
+                del self.toSocket[:self.iSocket]
+                self.iSocket = 0
+
+        if events & selectors.EVENT_READ: # Also how hangups and errors are reported
+            n = self.conn.recv_into(self.scratch)
+            if not n: # EOF
+                self.poller.unregister(self.conn.fileno())
+                self.conn.close()
+                self.conn = None
+                logging.info('FauxDS closed connection')
+            else:
+                self.toFile += self.scratch[:n]
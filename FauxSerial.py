@@ -5,13 +5,16 @@
 # Jan-2020, Pat Welch, pat@mousebrains.com
 
 import pty
+import tty
 import os
 import threading
 import argparse
 import logging
-import select
+import selectors
+from Poller import Poller
 
 fauxSerial = None
+maxSize = 65536 # Maximum length of internal buffers
 
 def addArgs(parser:argparse.ArgumentParser) -> None:
     ''' Add my command line arguments '''
@@ -38,6 +41,7 @@ class FauxSerial(threading.Thread):
         threading.Thread.__init__(self, daemon=True)
         self.args = args
         (self.master, self.slave) = pty.openpty() # Create a pseudo-tty pair
+        tty.setraw(self.slave) # No echo/line editing before the serial side opens it
         self.port = os.ttyname(self.slave)
 
     def run(self) -> None: # Called on start
@@ -48,89 +52,104 @@ class FauxSerial(threading.Thread):
     
     def runMain(self) -> None:
         args = self.args
-        master = self.master
 
         ifn = args.input
         ofn = args.output
 
         qMagic = ofn == '/dev/null'
 
-        ifp = open(ifn, 'rb')
-        ofp = open(ofn, 'wb')
+        self.ifp = open(ifn, 'rb', buffering=0) # Raw, so no read-ahead hides behind the fd
+        self.ofp = open(ofn, 'wb')
 
         logging.info('FauxSerial opened %s for input', ifn)
         logging.info('FauxSerial opened %s for output', ofn)
 
-        maxSize = 65536 # Maximum length of internal buffers
-        toSerial = bytearray() # Buffer to send to psuedo-tty
-        toFile = bytearray() # Buffer to send to the file
+        self.toSerial = bytearray() # Buffer to send to psuedo-tty
+        self.toFile = bytearray() # Buffer to send to the file
+        self.iSerial = 0 # Bytes of toSerial already sent
+        self.iFile = 0 # Bytes of toFile already written
+        self.scratch = memoryview(bytearray(maxSize)) # Reused for every read
+
+        poller = Poller()
+        self.poller = poller
+        ifpFD = self.ifp.fileno()
+        ofpFD = self.ofp.fileno()
+        poller.register(self.master, 0, self.__masterReady)
+        poller.register(ifpFD, 0, self.__fileReadable)
+        poller.register(ofpFD, 0, self.__fileWritable)
 
         dtExtra = None # Time to wait before closing the master device
 
         while True:
-            inputs = []
-            outputs = []
-            exceptables = []
-
-            if master is not None:
-                exceptables.append(master)
-                if len(toFile) < maxSize:
-                    inputs.append(master)
-                if len(toSerial) > 0:
-                    outputs.append(master)
-            elif not len(toFile): # Master is None and nothing left to write to file, so close ofp
-                ofp.close()
-                ofp = None
+            nSerial = len(self.toSerial) - self.iSerial # Bytes waiting to go to the master
+            nFile = len(self.toFile) - self.iFile # Bytes waiting to go to the output file
+
+            if self.master is not None:
+                poller.modify(self.master, \
+                        (selectors.EVENT_READ if nFile < maxSize else 0) | \
+                        (selectors.EVENT_WRITE if nSerial > 0 else 0))
+            elif nFile <= 0: # Master is None and nothing left to write to file, so close ofp
+                poller.unregister(ofpFD)
+                self.ofp.close()
+                self.ofp = None
                 logging.info('FauxSerial closing output, %s, since master is None', ofn)
                 break
 
-            if ifp is not None:
-                if len(toSerial) < maxSize:
-                    inputs.append(ifp)
-            elif qMagic and not len(toSerial): # Nothing left to send to master
+            if self.ifp is not None:
+                poller.modify(ifpFD, selectors.EVENT_READ if nSerial < maxSize else 0)
+            elif qMagic and (nSerial <= 0): # Nothing left to send to master
                 dtExtra = 10 # Wait 10 seconds for additional input from master
 
-            if (ofp is not None) and (len(toFile) > 0): outputs.append(ofp)
-
-            (ifps, ofps, efps) = select.select(inputs, outputs, exceptables, dtExtra)
+            poller.modify(ofpFD, selectors.EVENT_WRITE if nFile > 0 else 0)
 
-            if not ifps and not ofps and not efps: # Timeout
+            if not poller.dispatch(dtExtra): # Timeout
                 logging.info('FauxSerial shutting down due to timeout')
-                if master is not None:
-                    os.close(master)
-                    master = None
-                if ifp is not None:
-                    ifp.close()
-                    ifp = None
-                if ofp is not None:
-                    ofp.close()
-                    ofp = None
+                if self.master is not None:
+                    poller.unregister(self.master)
+                    os.close(self.master)
+                    self.master = None
+                if self.ifp is not None:
+                    self.ifp.close()
+                    self.ifp = None
+                if self.ofp is not None:
+                    self.ofp.close()
+                    self.ofp = None
                 break
 
-            for fp in efps:
-                os.close(fp) # Close the master on exception
-                master = None
-                logging.info('FauxSerial Closing master PTY, %s', fp)
-
-            for fp in ifps:
-                if isinstance(fp, int): # read from master
-                    toFile += os.read(fp, 1)
-                else:
-                    c = fp.read(1)
-                    if c == b'': # EOF
-                        ifp.close()
-                        ifp = None
-                        logging.info('FauxSerial Closed %s', ifn)
-                    else:
-                        toSerial += c
-
-            for fp in ofps:
-                if isinstance(fp, int): # write to master
-                    n = os.write(fp, toSerial)
-                    toSerial = toSerial[n:]
-                else:
-                    n = fp.write(toFile)
-                    fp.flush()
-                    toFile = toFile[n:]
-
+        poller.close()
         logging.info('FauxSerial Fell out of while loop')
+
+    def __masterReady(self, events:int) -> None:
+        fd = self.master
+        try:
+            if events & selectors.EVENT_WRITE: # write to master
+                self.iSerial += os.write(fd, memoryview(self.toSerial)[self.iSerial:])
+                if self.iSerial > (len(self.toSerial) // 2): # Only compact once enough has been consumed
+                    del self.toSerial[:self.iSerial]
+                    self.iSerial = 0
+
+            if events & selectors.EVENT_READ: # read from master
+                n = os.readv(fd, [self.scratch[:maxSize - len(self.toFile) + self.iFile]])
+                self.toFile += self.scratch[:n]
+        except OSError as e: # Hangups come back as errors, EIO once the slave side closes
+            self.poller.unregister(fd)
+            os.close(fd) # Close the master on exception
+            self.master = None
+            logging.info('FauxSerial Closing master PTY, %s, %s', fd, e)
+
+    def __fileReadable(self, events:int) -> None:
+        n = self.ifp.readinto(self.scratch[:maxSize - len(self.toSerial) + self.iSerial])
+        if not n: # EOF
+            self.poller.unregister(self.ifp.fileno())
+            self.ifp.close()
+            self.ifp = None
+            logging.info('FauxSerial Closed %s', self.args.input)
+        else:
+            self.toSerial += self.scratch[:n]
+
+    def __fileWritable(self, events:int) -> None:
+        self.iFile += self.ofp.write(memoryview(self.toFile)[self.iFile:])
+        self.ofp.flush()
+        if self.iFile > (len(self.toFile) // 2):
+            del self.toFile[:self.iFile]
+            self.iFile = 0
@@ -7,6 +7,8 @@
 import argparse
 import logging
 import logging.handlers
+import queue
+import atexit
 
 def addArgs(parser:argparse.ArgumentParser) -> None:
     grp = parser.add_argument_group('Logger Related Options')
@@ -34,6 +36,23 @@ def mkLogger(args:argparse.ArgumentParser) -> logging.Logger:
     formatter = logging.Formatter('%(asctime)s %(levelname)s: %(message)s')
     ch.setFormatter(formatter)
 
-    logger.addHandler(ch)
+    # The format does not use these, so don't collect them for every record
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+
+    # Callers only enqueue records, the file/stream I/O happens on the listener's thread
+    q = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(q, ch, respect_handler_level=True)
+    listener.start()
+
+    qh = logging.handlers.QueueHandler(q)
+    logger.addHandler(qh)
+
+    def stop() -> None: # On exit flush what is queued, then log directly during shutdown
+        listener.stop()
+        logger.removeHandler(qh)
+        logger.addHandler(ch)
+    atexit.register(stop)
     
     return logger 
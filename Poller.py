@@ -0,0 +1,72 @@
+#
+# Level triggered selector wrapper which dispatches events to a handler per file descriptor
+#
+# Uses selectors.DefaultSelector, so epoll on Linux and kqueue on macOS.
+# Regular files and character devices other than ttys, e.g. /dev/null,
+# are always ready for I/O, so they are tracked here and reported as
+# ready whenever they are wanted. The selectors disagree about them,
+# epoll refuses them and kqueue only reports a file readable before EOF.
+#
+
+import os
+import selectors
+import stat
+
+class Poller:
+    ''' Keep a persistent selector and a handler for each file descriptor '''
+    def __init__(self) -> None:
+        self.selector = selectors.DefaultSelector()
+        self.masks = {} # Event mask currently registered with the selector for each fd
+        self.files = {} # Event mask for each always ready fd, kept out of the selector
+        self.handlers = {} # Handler to call with the events for each fd
+
+    def register(self, fd:int, mask:int, handler) -> None:
+        ''' Start watching fd for the events in mask, calling handler(events) when ready '''
+        mode = os.fstat(fd).st_mode
+        if stat.S_ISREG(mode) or (stat.S_ISCHR(mode) and not os.isatty(fd)): # Always ready
+            self.files[fd] = mask
+        else:
+            self.masks[fd] = 0
+            self.modify(fd, mask)
+        self.handlers[fd] = handler
+
+    def modify(self, fd:int, mask:int) -> None:
+        ''' Change the events fd is watched for, only telling the kernel when they change '''
+        if fd in self.files:
+            self.files[fd] = mask
+            return
+        current = self.masks[fd]
+        if current == mask:
+            return
+        if not mask: # Selectors can't hold an empty mask, so drop fd until it is wanted
+            self.selector.unregister(fd)
+        elif not current:
+            self.selector.register(fd, mask)
+        else:
+            self.selector.modify(fd, mask)
+        self.masks[fd] = mask
+
+    def unregister(self, fd:int) -> None:
+        ''' Stop watching fd, call before closing it '''
+        if self.masks.pop(fd, 0):
+            self.selector.unregister(fd)
+        self.files.pop(fd, None)
+        self.handlers.pop(fd, None)
+
+    def poll(self, timeout:float=None) -> list:
+        ''' Wait up to timeout seconds, None is forever, and return a list of (fd, events) '''
+        ready = [(fd, mask) for (fd, mask) in self.files.items() if mask]
+        events = self.selector.select(0 if ready else timeout)
+        return [(key.fd, mask) for (key, mask) in events] + ready
+
+    def dispatch(self, timeout:float=None) -> bool:
+        ''' Poll and call the handler for each ready fd, returning False on a timeout '''
+        events = self.poll(timeout)
+        for (fd, mask) in events:
+            handler = self.handlers.get(fd) # An earlier handler may have unregistered fd
+            if handler is not None:
+                handler(mask)
+        return bool(events)
+
+    def close(self) -> None:
+        self.selector.close()
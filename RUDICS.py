@@ -7,10 +7,25 @@ import argparse
 import logging
 import re
 import time
-import math
 import socket
+import errno
+import os
+import collections
 from RealSerial import baudrates
 
+try: # Optional DFA based scanner for the trigger patterns
+    import hyperscan
+except ImportError:
+    hyperscan = None
+
+maxIOV = 1024 # Most buffers to hand sendmsg at once, the usual IOV_MAX
+maxRead = 65536 # Size of the arenas socket reads go into
+minRead = 4096 # Start a new arena when less than this is left in the current one
+minPaceNs = 1_000_000 # Least time, in ns, between paced sends, the credit builds up meanwhile
+maxBurstNs = 100_000_000 # Most idle time, in ns, paced bytes can be sent back to back for
+socketBuffer = 1 << 20 # Kernel send and receive buffer sizes for the RUDICS socket
+maxLineLength = 4096 # Only the last this many bytes of a line are scanned for triggers
+
 class RUDICS:
     def __init__(self, args:argparse.ArgumentParser) -> None:
         self.args = args
@@ -28,27 +43,52 @@ class RUDICS:
                     ]
                 )
                     # 'behavior dive_to_\d+:\s+SUBSTATE \d+ ->\d+ : diving',
-        self.bytesPerSecond = \
+        self.triggerOnSearch = self.__mkSearch(self.triggerOn, # Bound once, used for every line
+                self.__mkLiterals(args.triggerOnLiteral, args.triggerOn,
+                    ['SUBSTATE', 'abort_the_mission']))
+        # The default off pattern starts with a literal, so re finds it faster than a prefilter
+        self.triggerOffSearch = self.__mkSearch(self.triggerOff,
+                self.__mkLiterals(args.triggerOffLiteral, args.triggerOff, None))
+        self.nsPerByte = \
                 None if (args.rudicsBaudrate is None) or (args.rudicsBaudrate < 1) \
-                else (9 / args.rudicsBaudrate) # Time to send 9 bits
-        self.buffer = bytearray()
-        self.line = bytearray()
+                else (9 * 1_000_000_000 // args.rudicsBaudrate) # Nanoseconds to send 9 bits
+        self.idleTimeout = args.idleTimeout
+        self.chunks = collections.deque() # Memoryviews of the bytes waiting to be sent
+        self.chunksAppend = self.chunks.append
+        self.nBuffer = 0 # Total bytes waiting to be sent in self.chunks
+        self.arena = memoryview(bytearray(maxRead)) # Socket reads are packed into this
+        self.iArena = 0 # Bytes of arena already handed out
+        self.line = bytearray(maxLineLength) # Fixed size, so it is never reallocated
+        self.lineView = memoryview(self.line)
+        self.nLine = 0 # Bytes of the current line in self.line
         self.tLastOpen = 0
         self.tLastClose = 0
-        self.tLastSend = 0
-        self.tNextSend = 0
+        self.tPaceNs = 0 # When the bytes sent so far were due by at the baudrate, a token bucket
+        self.tNextSendNs = 0
         self.tNextOpen = 0
         self.tLastAction = None
         self.qWantOpen = not args.disconnected # Initially connection state
+        self.qConnecting = False # A non-blocking connect is in progress on self.s
+        self.retryDelay = args.rudicsDelay # Wait after the next failed connect
+        self.addr = None # Resolved (host, port), looked up again after a failed connect
         self.s = None
+        self.__bindSocket(None)
+        self.tick(time.monotonic_ns())
+        self.__setDeadline()
 
     @staticmethod
     def addArgs(parser:argparse.ArgumentParser) -> None:
         grp = parser.add_argument_group('RUDICS Trigger on/off Options')
         grp.add_argument('--triggerOff', action='append',
-                help='Shutdown Dockserver connection after this line seen')
+                help='Shutdown Dockserver connection after this line seen, ' \
+                        + f'must match within the last {maxLineLength} bytes of a line')
         grp.add_argument('--triggerOn', action='append', 
-                help='Start Dockserver connection after this line seen')
+                help='Start Dockserver connection after this line seen, ' \
+                        + f'must match within the last {maxLineLength} bytes of a line')
+        grp.add_argument('--triggerOffLiteral', action='append',
+                help='Only lines containing one of these, ignoring case, are checked for --triggerOff')
+        grp.add_argument('--triggerOnLiteral', action='append',
+                help='Only lines containing one of these, ignoring case, are checked for --triggerOn')
         grp.add_argument('--idleTimeout', type=int, default=3600,
                 help='If not input from either the serial or socket in this period of time, drop the connection')
         grp = parser.add_argument_group('Real RUDICS')
@@ -60,6 +100,8 @@ class RUDICS:
                 help='Baudrate to feed characters to the RUDICS connection at')
         grp.add_argument('--rudicsDelay', type=int, default=120,
                 help="Delay between retrys at connecting to the RUDICS port")
+        grp.add_argument('--rudicsMaxDelay', type=int, default=300,
+                help="Longest delay between retrys, which double from --rudicsDelay after each failure")
         grp.add_argument('--rudicsMaxOpenTime', type=int, default=86400,
                 help="Maximumm length of time a single RUDICS connection can be open")
         grp.add_argument('--rudicsMaxOpenTimeDelay', type=int, default=1800,
@@ -73,7 +115,7 @@ class RUDICS:
         self.close()
 
     def __bool__(self) -> bool:
-        return (self.s is not None) and (len(self.buffer) > 0)
+        return (self.s is not None) and (self.nBuffer > 0)
 
     def __mkTrigger(self, items:list, defaults:list):
         # If items has only one item, then that is the pattern
@@ -85,131 +127,273 @@ class RUDICS:
             a = '(' + '|'.join(items) + ')'
         return re.compile(bytes(a, 'utf-8'), re.IGNORECASE)
 
-    def timeout(self) -> float:
-        now = time.time()
-        dt = max(1, self.args.idleTimeout - \
+    def __mkLiterals(self, literals:list, items:list, defaults:list) -> tuple:
+        # Lowercase literals one of which every matching line contains, or None to check every line.
+        # The defaults go with the default patterns, so are not used if patterns were given.
+        # Prefiltering copies and lowercases each line, so only pays off for slow patterns.
+        if not literals:
+            literals = None if items else defaults
+        return None if literals is None else tuple(bytes(a, 'utf-8').lower() for a in literals)
+
+    def __mkReSearch(self, trigger:re.Pattern, literals:tuple):
+        # Return trigger.search, only run on lines which contain one of literals if there are any
+        if literals is None:
+            return trigger.search
+
+        def search(line:bytes) -> bool:
+            lower = bytes(line).lower()
+            for literal in literals:
+                if literal in lower:
+                    return bool(trigger.search(line))
+            return False
+        return search
+
+    def __mkSearch(self, trigger:re.Pattern, literals:tuple):
+        # Return a function which is true if the trigger is found in a line.
+        # Use hyperscan if it is installed and accepts the pattern, else fall back to re
+        if hyperscan is None:
+            return self.__mkReSearch(trigger, literals)
+        try:
+            db = hyperscan.Database(mode=hyperscan.HS_MODE_BLOCK)
+            db.compile(expressions=[trigger.pattern],
+                    flags=[hyperscan.HS_FLAG_CASELESS | hyperscan.HS_FLAG_SINGLEMATCH])
+        except hyperscan.error:
+            logging.warning('hyperscan rejected %s, using re', trigger.pattern)
+            return self.__mkReSearch(trigger, literals)
+
+        def search(line:bytes) -> bool:
+            found = []
+            db.scan(bytes(line), match_event_handler=lambda *args: found.append(True))
+            return bool(found)
+        return search
+
+    def tick(self, nowNs:int) -> None:
+        ''' Set the time.monotonic_ns() used by everything done until the next tick '''
+        self.nowNs = nowNs
+        self.now = nowNs / 1e9 # Monotonic seconds for the coarse timers
+
+    def __setDeadline(self) -> None:
+        # Cache the monotonic time doit should wake up by, call whenever what it depends on changes
+        now = self.now
+        deadline = now + max(1, self.idleTimeout - \
                 (0 if self.tLastAction is None else (now - self.tLastAction)))
 
-        if not len(self.buffer):
-            return dt # Nothing to send, so wait this long
+        if self.nBuffer > 0: # Something to send, so also wake up for the next open or paced send
+            if self.tNextOpen > now:
+                deadline = min(deadline, self.tNextOpen)
+            if self.tNextSendNs > self.nowNs:
+                deadline = min(deadline, self.tNextSendNs / 1e9)
 
-        if self.tNextOpen > now:
-            if self.tNextSend > now:
-                return min(dt, min(self.tNextOpen, self.tNextSend) - now)
-            return min(dt, self.tNextOpen - now)
-        if self.tNextSend > now:
-            return min(dt, self.tNextSend - now)
-        return dt
+        self.deadline = deadline
 
     def timedOut(self) -> None:
-        if self.tLastOpen <= 0: return
-        now = time.time()
-        dt = now - self.tLastOpen # Time since last 
-        if dt >= self.args.idleTimeout:
-            logging.info('Idle timeout')
-            self.close()
-            self.tLastAction = now
+        if (self.tLastOpen > 0) and not self.qConnecting:
+            now = self.now
+            dt = now - self.tLastOpen # Time since last 
+            if dt >= self.idleTimeout:
+                logging.info('Idle timeout')
+                self.close()
+                self.tLastAction = now
+        self.__setDeadline() # On every path, else a passed deadline keeps doit spinning
 
     def send(self) -> None:
-        logging.debug('RUDICS:send %s', len(self.buffer))
-        now = time.time()
+        nBuffer = self.nBuffer # Bytes waiting to be sent
+        nowNs = self.nowNs
 
-        if (self.s is None) or (not len(self.buffer)) or (self.tNextSend >= now):
+        if self.qConnecting: # Writable, so the connect has finished one way or the other
+            self.__finishConnect(self.s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR))
             return
 
-        if self.bytesPerSecond is None: # Not baudrate limited
-            n = len(self.buffer) # Send whole buffer
-        else: # baudrate limited
-            self.tNextSend = now + self.bytesPerSecond
-            dt = now - self.tLastSend # Time since the last send
-            n = math.floor(dt / self.bytesPerSecond) # How many bytes can be sent
+        if (self.s is None) or (nBuffer <= 0) or (self.tNextSendNs > nowNs):
+            return
+
+        if self.nsPerByte is None: # Not baudrate limited
+            n = nBuffer # Send whole buffer
+        else: # baudrate limited, the fraction of a byte left over is kept for next time
+            tPaceNs = max(self.tPaceNs, nowNs - maxBurstNs) # Cap the credit built up while idle
+            n = (nowNs - tPaceNs) // self.nsPerByte # How many bytes can be sent
             if n <= 0:
+                self.tNextSendNs = max(tPaceNs + self.nsPerByte, nowNs + minPaceNs)
+                self.__setDeadline()
                 return
 
-        if n >= len(self.buffer):
-            m = self.write(self.buffer)
+        while True: # Unpaced, keep writing until the queue drains or the kernel pushes back
+            views = [] # Gather up to n bytes from the front of the queue without copying
+            size = 0
+            for view in self.chunks:
+                if (size >= n) or (len(views) >= maxIOV):
+                    break
+                view = view[:n - size]
+                views.append(view)
+                size += len(view)
+
+            m = self.write(views)
+
+            if logging.root.isEnabledFor(logging.DEBUG):
+                logging.debug('RUDICS:sent m=%s n=%s len=%s', m, n, nBuffer)
+
+            self.nBuffer -= m
+            chunks = self.chunks
+            left = m
+            while left > 0: # Drop what was sent from the front of the queue
+                view = chunks[0]
+                if len(view) <= left:
+                    chunks.popleft()
+                    left -= len(view)
+                else:
+                    chunks[0] = view[left:]
+                    left = 0
+
+            if (self.nsPerByte is not None) or (m < size) or (self.nBuffer <= 0):
+                break
+            n = nBuffer = self.nBuffer
+
+        if self.nsPerByte is not None: # Spend the credit for what was sent
+            self.tPaceNs = tPaceNs + m * self.nsPerByte
+            self.tNextSendNs = max(self.tPaceNs + self.nsPerByte, nowNs + minPaceNs)
+        self.__setDeadline()
+
+    def put(self, data:bytes) -> None:
+        self.tLastAction = self.now
+        view = memoryview(bytes(data)) # bytes(data) is free if data is already bytes
+        qWantOpen = self.qWantOpen
+        iSend = 0 # Start of the run of data to be sent, if qWantOpen
+
+        start = 0
+        while True: # Walk through the full lines in data
+            index = data.find(b'\n', start)
+            if index < 0: # No more full lines, so save the fragment for next time
+                self.__addToLine(data, start, len(data))
+                break
+            if self.nLine: # Finish the fragment saved from earlier data
+                self.__addToLine(data, start, index + 1)
+                line = self.lineView[:self.nLine]
+                self.nLine = 0 # Reuse self.line for the next line
+            else: # The whole line is in data, so check it in place without copying
+                line = view[max(start, index + 1 - maxLineLength):index + 1]
+            start = index + 1
+            self.__checkLine(line)
+            if self.qWantOpen != qWantOpen: # A trigger fired on this line
+                if qWantOpen: # Turned off, so send up to and including this line
+                    self.__queue(view[iSend:start])
+                else: # Turned on, so send what follows this line
+                    iSend = start
+                qWantOpen = self.qWantOpen
+
+        if qWantOpen:
+            self.__queue(view[iSend:])
+        self.__setDeadline()
+
+    def __queue(self, view:memoryview) -> None:
+        # Append a run of bytes to be sent to the output queue
+        if len(view):
+            self.chunksAppend(view)
+            self.nBuffer += len(view)
+
+    def __addToLine(self, data:bytes, start:int, end:int) -> None:
+        # Append data[start:end] to self.line, keeping only the last maxLineLength bytes.
+        # Only equal length slice assignments are used, so self.line is never resized.
+        n = end - start
+        nLine = self.nLine
+        if (nLine + n) <= maxLineLength:
+            self.line[nLine:nLine + n] = data[start:end]
+            self.nLine = nLine + n
+        elif n >= maxLineLength: # A runaway line, keep the tail of data
+            self.line[:] = data[end - maxLineLength:end]
+            self.nLine = maxLineLength
+        else: # Slide what is kept of the current line down to make room
+            nKeep = maxLineLength - n
+            self.line[:nKeep] = self.line[nLine - nKeep:nLine]
+            self.line[nKeep:] = data[start:end]
+            self.nLine = maxLineLength
+
+    def __checkLine(self, line:bytes) -> None:
+        # Check a full line from the serial port to see if the connection should be turned on/off
+        if logging.root.isEnabledFor(logging.INFO): # Only decode the line if it will be logged
+            # Decoded straight from the view, undecodable bytes are escaped rather than retried
+            logging.info('qWantOpen %s line=%s', self.qWantOpen,
+                    str(line, "utf-8", "backslashreplace").strip())
+
+        if self.qWantOpen: # Check if we should turn off?
+            self.qWantOpen = not self.triggerOffSearch(line)
+            if not self.qWantOpen: self.close()
         else:
-            m = self.write(self.buffer[0:n])
-
-        logging.debug('RUDICS:sent full buffer m=%s n=%s len=%s buffer=%s', 
-                m, n, len(self.buffer), self.buffer)
+            self.qWantOpen = bool(self.triggerOnSearch(line))
+            if self.qWantOpen: self.open()
 
-        self.buffer = self.buffer[m:]
-
-        if m > 0:
-            self.tLastSend = now
-
-    def put(self, c:bytes) -> None:
-        self.tLastAction = time.time()
-        if self.qWantOpen:
-            self.buffer += c
-
-        self.line += c
-        if not self.line.find(b'\n') >= 0: return # No full lines in self.line
-        for line in self.line.split(b"\n"):
-            if not line: continue # Empty buffer, probably the last one
-            if line[-1:] != b'\r': 
-                self.line = line
-                return
-            try:
-                msg = str(line, "utf-8")
-            except:
-                msg = bytes(line)
-
-            logging.info('qWantOpen %s line=%s', self.qWantOpen, msg.strip())
-            if self.qWantOpen: # Check if we should turn off?
-                self.qWantOpen = self.triggerOff.search(self.line) is None
-                if not self.qWantOpen: self.close()
-            else:
-                self.qWantOpen =  self.triggerOn.search(self.line) is not None
-                if self.qWantOpen: self.open()
-        self.line = bytearray()
-
-    def get(self, n:int) -> bytes:
-        self.tLastAction = time.time()
+    def get(self, n:int) -> memoryview:
+        ''' Read up to n bytes, the result stays valid for as long as it is held '''
+        self.tLastAction = self.now
         c = self.read(n)
         if not len(c): # Connection dropped
             self.close()
-        logging.info('get n=%s c=%s', n, c)
+        if logging.root.isEnabledFor(logging.DEBUG): # Skip the repr of c otherwise
+            logging.debug('get n=%s len=%s c=%s', n, len(c), bytes(c))
+        self.__setDeadline()
         return c
 
-    def inputFileno(self) -> int:
+    def ensureOpen(self) -> None:
+        ''' Connect if a connection is wanted but not open, call once per tick '''
         if self.qWantOpen and (self.s is None):
             self.open()
-        return self.s
 
-    def outputFileno(self) -> int:
-        if self.qWantOpen and (self.s is None):
-            self.open()
-        return self.s if len(self.buffer) and (time.time() >= self.tNextSend) else None
+    def inputFileno(self) -> socket.socket:
+        return None if self.qConnecting else self.s
+
+    def outputFileno(self) -> socket.socket:
+        if self.qConnecting: # Writable once the connect has finished
+            return self.s
+        return self.s if (self.nBuffer > 0) and (self.nowNs >= self.tNextSendNs) else None
 
 
     def qOpen(self) -> bool:
         return self.s is not None
 
-    def write(self, buffer:bytes) -> int:
+    def write(self, buffers:list) -> int:
+        # Gather write buffers in a single syscall, returning how many bytes were sent
         try:
             if self.s is not None:
-                return self.s.send(buffer)
+                return self.sSendMsg(buffers)
+        except BlockingIOError: # Kernel send buffer is full, try again next time
+            return 0
         except:
-            logging.exception('Exception while writing %s', buffer)
+            logging.exception('Exception while writing %s buffers', len(buffers))
             self.close()
             self.qWantOpen = True
         return 0
 
-    def read(self, n:int) -> bytes:
+    def read(self, n:int) -> memoryview:
         try:
             if self.s is not None:
-                return self.s.recv(n)
+                # Pack reads into an arena and hand out views of it, so the bytes
+                # reach the serial port without being copied. A full arena is
+                # dropped and freed once the last view of it has been written.
+                if (maxRead - self.iArena) < minRead:
+                    self.arena = memoryview(bytearray(maxRead))
+                    self.iArena = 0
+                i = self.iArena
+                tail = self.arena[i:i + n] if n < (maxRead - i) else self.arena[i:]
+                m = self.sRecvInto(tail)
+                self.iArena = i + m
+                return tail[:m]
         except:
             logging.exception('Exception while receiving %s', n)
             self.close()
             self.qWantOpen = True
         return b''
 
+    def __bindSocket(self, s:socket.socket) -> None:
+        # Cache the socket's bound methods so the I/O paths skip the lookups
+        self.sSendMsg = None if s is None else s.sendmsg
+        self.sRecvInto = None if s is None else s.recv_into
+
     def close(self) -> None:
         self.qWantOpen = False # I don't want to be open
+        # The next session backs off afresh rather than inheriting this one's delay
+        self.retryDelay = self.args.rudicsDelay
+        self.tNextOpen = min(self.tNextOpen, self.now + self.args.rudicsDelay)
         if self.s is None:
+            self.__setDeadline()
             return
 
         try: # Shutdown seems to hold the connection open????
@@ -220,29 +404,69 @@ class RUDICS:
             logging.exception('Error closing %s:%s', self.args.host, self.args.port)
 
         self.s = None
-        now = time.time()
+        self.qConnecting = False
+        self.__bindSocket(None)
+        now = self.now # This tick, no need to read the clock again
         self.tLastClose = now
         self.tNextOpen = max(self.tNextOpen, now + self.args.rudicsDelay)
+        self.__setDeadline()
 
     def open(self) -> None:
-        if self.s is not None: # Already open
+        if self.s is not None: # Already open or connecting
             return
 
-        if time.time() < self.tNextOpen: # Don't open yet
+        if self.now < self.tNextOpen: # Don't open yet
             self.qWantOpen = True # We want to be open
             return
 
         args = self.args
+        self.qWantOpen = True # We want to be open
+        s = None
         try:
             s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.settimeout(None) # Non-blocking
-            s.connect((args.host, args.port)) # Connect to RUDICS listener on a Dockserver
-            logging.info('Connected to %s:%s', args.host, args.port)
-            self.s = s
-            self.tLastOpen = time.time()
-            self.qWantOpen = True # I'm now open
-        except:
-            self.tNextOpen = time.time() + args.rudicsDelay
-            self.qWantOpen = True # We want to be open
-            logging.exception('Unexpected error connecting to %s:%s, wait %s seconds to retry',
-                    args.host, args.port, args.rudicsDelay)
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # No Nagle delay on small writes
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, socketBuffer) # Absorb bursts
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, socketBuffer)
+            if self.addr is None: # Blocking lookup, so only on the first try and after failures
+                self.addr = socket.getaddrinfo(args.host, args.port,
+                        socket.AF_INET, socket.SOCK_STREAM)[0][4]
+            s.setblocking(False) # Connect in the background, the select loop keeps running
+            err = s.connect_ex(self.addr) # Connect to RUDICS listener on a Dockserver
+        except Exception as e:
+            if s is not None: s.close()
+            self.__connectFailed(str(e))
+            return
+
+        self.s = s
+        if err in (errno.EINPROGRESS, errno.EWOULDBLOCK): # Finishes when the socket is writable
+            self.qConnecting = True
+            logging.info('Connecting to %s:%s', args.host, args.port)
+            self.__setDeadline()
+        else: # Finished, or failed, already
+            self.__finishConnect(err)
+
+    def __finishConnect(self, err:int) -> None:
+        # The connect has finished, err is 0 on success, else an errno
+        args = self.args
+        self.qConnecting = False
+        if err:
+            self.s.close()
+            self.s = None
+            self.__connectFailed(os.strerror(err))
+            return
+
+        logging.info('Connected to %s:%s', args.host, args.port)
+        self.__bindSocket(self.s)
+        self.tLastOpen = self.now
+        self.retryDelay = args.rudicsDelay # Start backing off afresh after the next failure
+        self.__setDeadline()
+
+    def __connectFailed(self, msg:str) -> None:
+        # Schedule the next try, doubling the delay after each failure up to rudicsMaxDelay
+        args = self.args
+        logging.error('Error connecting to %s:%s, %s, wait %s seconds to retry',
+                args.host, args.port, msg, self.retryDelay)
+        self.tNextOpen = self.now + self.retryDelay
+        self.addr = None # The address may have moved, so look it up again next time
+        self.retryDelay = min(2 * self.retryDelay, max(args.rudicsDelay, args.rudicsMaxDelay))
+        self.__setDeadline()
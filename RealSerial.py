@@ -6,14 +6,24 @@
 import argparse
 import logging
 import serial
+import os
+import time
+import collections
 import logging
 
 baudrates = serial.Serial.BAUDRATES
+maxWrite = 4096 # Most bytes handed to the serial driver in one write, about a tty buffer
+maxIOV = 1024 # Most views in one writev, Linux's IOV_MAX
 
 class RealSerial:
     def __init__(self, args:argparse.ArgumentParser) -> None:
         self.args = args
-        self.buffer = bytearray()
+        self.buffer = collections.deque() # memoryviews waiting to be written
+        self.nBuffer = 0 # Bytes in buffer
+        self.flushDelay = args.serialFlushDelay
+        self.highWater = args.serialHighWater
+        self.tFlush = 0 # When the oldest byte in buffer must be written by
+        self.tick(time.monotonic_ns())
         self.__open()
 
     @staticmethod
@@ -27,30 +37,70 @@ class RealSerial:
                 default=8, help='Bits/byte')
         grp.add_argument('--stopbits', type=float, choices=serial.Serial.STOPBITS,
                 default=1, help='Number of stop bits')
+        grp.add_argument('--serialFlushDelay', type=float, default=0.02,
+                help='Seconds to hold bytes for the serial port so they go out in fewer writes')
+        grp.add_argument('--serialHighWater', type=int, default=1024,
+                help='Write to the serial port without waiting once this many bytes are waiting')
 
-    def __del__(self) -> None: # Destructor
-        logging.info('Destroying Serial %s', self.port)
-        self.close()
+    def tick(self, nowNs:int) -> None:
+        ''' Set the time.monotonic_ns() used by everything done until the next tick '''
+        self.now = nowNs / 1e9
 
     def __bool__(self) -> bool:
-        return (self.fp is not None) or bool(len(self.buffer))
+        return self.fp is not None
 
     def inputFileno(self) -> serial.Serial: 
         return self.fp
 
     def outputFileno(self) -> serial.Serial: 
-        return self.fp if len(self.buffer) else None
+        # Coalesce trickling bytes into one write, like Nagle, unless enough are waiting
+        buffer = self.buffer
+        if buffer and ((self.nBuffer >= self.highWater) or (self.now >= self.tFlush)):
+            return self.fp
+        return None
+
+    def timeout(self) -> float:
+        ''' Seconds until held bytes must be written, or None if nothing is held '''
+        if (self.fp is None) or not self.buffer or (self.nBuffer >= self.highWater):
+            return None
+        dt = self.tFlush - self.now
+        return dt if dt > 0 else None # Once due, the write registration wakes doit
 
     def exceptionFileno(self) -> serial.Serial:
         return self.fp
 
     def send(self) -> None:
-        if (self.fp is not None) and len(self.buffer):
-            n = self.fp.write(self.buffer[0:1]) # 1 at a time to not overload
-            self.buffer = self.buffer[n:]
+        if (self.fp is not None) and self.buffer:
+            views = [] # Gather queued views into one writev, stopping at about maxWrite bytes
+            size = 0
+            for view in self.buffer:
+                if (size >= maxWrite) or (len(views) >= maxIOV):
+                    break
+                views.append(view)
+                size += len(view)
+            try: # The fd is non-blocking, so this is however much the driver accepted
+                n = os.writev(self.fd, views)
+            except BlockingIOError:
+                n = 0
+            self.nBuffer -= n
+            buffer = self.buffer
+            while n > 0: # Drop what was written, advancing the view written into
+                view = buffer[0]
+                if n >= len(view):
+                    buffer.popleft()
+                    n -= len(view)
+                else: # No copy of the rest
+                    buffer[0] = view[n:]
+                    n = 0
 
     def put(self, c:bytes) -> None:
-        self.buffer += c
+        if self.fp is None: # Nowhere to write it
+            return
+        if not self.buffer: # The oldest byte waits at most flushDelay
+            self.tFlush = self.now + self.flushDelay
+        if len(c):
+            self.buffer.append(memoryview(c)) # Queued as is, no copy
+            self.nBuffer += len(c)
 
     def nAvailable(self) -> int:
         return self.fp.in_waiting if self.fp else 0
@@ -59,13 +109,15 @@ class RealSerial:
         if self.fp is None:
             return b''
         try:
-            c = self.fp.read(n)
+            c = os.read(self.fd, n)
             if len(c) == 0: # EOF
                 self.close()
             return c
-        except serial.serialutil.SerialException as e:
+        except BlockingIOError: # Nothing there after all, but still open
+            return b''
+        except OSError as e:
             logging.error('Unexpected exception while reading serial port, %s', str(e))
-        except:
+        except Exception:
             logging.exception('Unexpected exception while reading serial port')
 
         self.close()
@@ -79,6 +131,7 @@ class RealSerial:
             fp = serial.Serial(port=self.port, baudrate=args.baudrate, 
                     bytesize=args.bytesize, parity=args.parity, stopbits=args.stopbits)
             self.fp = fp
+            self.fd = fp.fileno() # pyserial configures the port, I/O goes straight to the fd
             logging.info('Opened serial port %s parity=%s baudrate=%s bytesize=%s stopbits=%s',
                 args.serial, args.parity, args.baudrate, args.bytesize, args.stopbits)
 
@@ -86,7 +139,7 @@ class RealSerial:
             logging.exception('Error opening serial port %s', self.port)
         except ValueError:
             logging.exception('Value error opening serial port %s', self.port)
-        except:
+        except Exception:
             logging.exception('Unexpected error opening serial port %s', self.port)
 
     def close(self) -> None:
@@ -98,6 +151,10 @@ class RealSerial:
             logging.info('Closed %s', self.port)
         except serial.serialutil.SerialException:
             logging.exception('Error closing serial port %s', self.port)
-        except:
+        except Exception:
             logging.exception('Unexpected error closing serial port %s', self.port)
         self.fp = None
+        if self.nBuffer:
+            logging.warning('Dropped %s bytes held for %s', self.nBuffer, self.port)
+        self.buffer.clear() # Can never be written, so don't keep doit alive for them
+        self.nBuffer = 0
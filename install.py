@@ -10,17 +10,25 @@ from tempfile import NamedTemporaryFile
 import yaml
 import socket
 import os
-import re
+from string import Template
 import time
 import sys
 
-def barebones(content:str) -> list[str]:
-    lines = []
-    for line in content.split("\n"):
-        line = line.strip()
-        if (len(line) == 0) or (line[0] == "#"): continue
-        lines.append(line)
-    return lines
+class ServiceTemplate(Template):
+    """ Substitute @KEY@ placeholders, leaving any other @ alone """
+    delimiter = "@"
+    pattern = r"""
+        @(?:
+          (?P<escaped>(?!)) |
+          (?P<named>[_a-z][_a-z0-9]*)@ |
+          (?P<braced>(?!)) |
+          (?P<invalid>(?!))
+        )"""
+
+def barebones(content:str) -> tuple[str]:
+    """ Non-blank, non-comment lines, stripped """
+    return tuple(line for line in map(str.strip, content.splitlines())
+            if line and (line[0] != "#"))
 
 parser = ArgumentParser()
 parser.add_argument("service", type=str, nargs="*", help="Service file(s) to copy")
@@ -60,6 +68,20 @@ args.serviceDirectory = os.path.abspath(os.path.expanduser(args.serviceDirectory
 
 root = os.path.dirname(os.path.abspath(__file__)) # Where the script is at
 
+replacements = { # What to substitute for each @KEY@ in a service file
+        "DATE": "Generated on " + time.asctime(),
+        "GENERATED": str(args),
+        "USERNAME": args.username,
+        "GROUPNAME": args.group,
+        "DIRECTORY": args.directory,
+        "EXECUTABLE": os.path.join(root, args.executable),
+        "HOSTNAME": args.hostname,
+        "PORT": str(args.port),
+        "BAUDRATE": str(args.baudrate),
+        "TIMEOUT": str(args.timeout),
+        "RESTARTSECONDS": str(args.restartSeconds),
+        }
+
 qDidSomething = False
 
 for service in args.service: # Walk through services to copy over
@@ -70,17 +92,11 @@ for service in args.service: # Walk through services to copy over
         continue
 
     with open(service, "r") as fp: input = fp.read() # Load the new service
-    input = re.sub(r"@DATE@", "Generated on " + time.asctime(), input)
-    input = re.sub(r"@GENERATED@", str(args), input)
-    input = re.sub(r"@USERNAME@", args.username, input)
-    input = re.sub(r"@GROUPNAME@", args.group, input)
-    input = re.sub(r"@DIRECTORY@", args.directory, input)
-    input = re.sub(r"@EXECUTABLE@", os.path.join(root, args.executable), input)
-    input = re.sub(r"@HOSTNAME@", args.hostname, input)
-    input = re.sub(r"@PORT@", str(args.port), input)
-    input = re.sub(r"@BAUDRATE@", str(args.baudrate), input)
-    input = re.sub(r"@TIMEOUT@", str(args.timeout), input)
-    input = re.sub(r"@RESTARTSECONDS@", str(args.restartSeconds), input)
+    try: # One pass, and an unknown @KEY@ is an error rather than left in place
+        input = ServiceTemplate(input).substitute(replacements)
+    except KeyError as e:
+        print(f"ERROR unknown placeholder @{e.args[0]}@ in {service}")
+        continue
 
     if not args.force and os.path.exists(target):
         try:
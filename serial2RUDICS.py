@@ -11,7 +11,7 @@
 
 import argparse
 import logging
-import select
+import selectors
 import MyLogger
 import FauxSerial
 import FauxDockServer
@@ -19,67 +19,120 @@ from RealSerial import RealSerial
 from RUDICS import RUDICS
 import time
 
+def reselect(sel:selectors.BaseSelector, registered:dict, fps:tuple) -> None:
+    ''' Bring sel's registrations in line with the (file, events, tag) in fps '''
+    wanted = {} # file -> [events, tag]
+    for (fp, events, tag) in fps:
+        if fp is not None:
+            wanted.setdefault(fp, [0, tag])[0] |= events
+
+    # Unregister first, a reopened file may have been given the fd a closed one had
+    for fp in [fp for fp in registered if fp not in wanted]:
+        sel.unregister(registered.pop(fp)[0]) # By fd, fp may already be closed
+
+    for (fp, (events, tag)) in wanted.items():
+        if fp not in registered:
+            fd = fp if isinstance(fp, int) else fp.fileno()
+            sel.register(fd, events, tag)
+            registered[fp] = (fd, events)
+        elif registered[fp][1] != events:
+            fd = registered[fp][0]
+            sel.modify(fd, events, tag)
+            registered[fp] = (fd, events)
+
 def doit(serial:RealSerial, rudics:RUDICS, binary:str=None) -> None:
-    ofp = open(binary, "wb") if binary else None
+    ofp = open(binary, "wb", buffering=1 << 20) if binary else None
+    tLogFlush = None # When what is buffered for ofp must be flushed by, None if nothing is
+
+    sel = selectors.DefaultSelector() # Persistent, only updated when a file comes or goes
+    registered = {} # file -> (fd, events) registered with sel
+    fps = None # The files sel was last brought in line with
+
+    # Bound methods used every pass, as locals to skip the attribute lookups
+    (sTick, sInput, sOutput, sTimeout) = \
+            (serial.tick, serial.inputFileno, serial.outputFileno, serial.timeout)
+    (sAvailable, sGet, sPut) = (serial.nAvailable, serial.get, serial.put)
+    (rInput, rOutput) = (rudics.inputFileno, rudics.outputFileno)
+    (rTick, rEnsureOpen, rGet, rPut) = (rudics.tick, rudics.ensureOpen, rudics.get, rudics.put)
+    rTimedOut = rudics.timedOut
+    monotonic_ns = time.monotonic_ns
+    select = sel.select
+    (READ, WRITE) = (selectors.EVENT_READ, selectors.EVENT_WRITE)
+
+    def serialReadable() -> None:
+        nonlocal tLogFlush
+        n = sAvailable() or 1 # All that is waiting, or block for one byte
+        c = sGet(n) # Drain the UART in one read, get closes the port on EOF
+        if len(c): 
+            rPut(c)
+            if ofp:
+                ofp.writelines((f"SERIAL {len(c)} : ".encode("ascii"), c, b'\n'))
+                if tLogFlush is None: tLogFlush = rudics.now + 1
+
+    def rudicsReadable() -> None:
+        nonlocal tLogFlush
+        c = rGet(1024 * 1024) # Read what is available, up to what is left in its arena
+        if len(c):
+            sPut(c)
+            if ofp:
+                ofp.writelines((f"RUDICS {len(c)} : ".encode("ascii"), c, b'\n'))
+                if tLogFlush is None: tLogFlush = rudics.now + 1
+        else: # EOF
+            rudics.close()
+
+    # What each side's selector key carries, (readable handler, send)
+    serialHandlers = (serialReadable, serial.send)
+    rudicsHandlers = (rudicsReadable, rudics.send)
 
     while bool(serial) or bool(rudics): # While an open serial port or stuff to send to RUDICS
-        ifpSerial = serial.inputFileno()
-        ofpSerial = serial.outputFileno()
-        ifpRUDICS = rudics.inputFileno()
-        ofpRUDICS = rudics.outputFileno()
-
-        ifps = [] # input file numbers to select on
-        ofps = [] # output file numbers to select on
-
-        if ifpSerial is not None: ifps.append(ifpSerial)
-        if ofpSerial is not None: ofps.append(ofpSerial)
-        if ifpRUDICS is not None: ifps.append(ifpRUDICS)
-        if ofpRUDICS is not None: ofps.append(ofpRUDICS)
-
-        timeout = rudics.timeout()
-        # logging.info('timeout=%s ifps=%s ofps=%s s %s r %s', 
-                # timeout, len(ifps), len(ofps), len(serial.buffer), len(rudics.buffer))
-        [readable, writeable, exceptable] = select.select(ifps, ofps, ifps, timeout)
-
-        if not readable and not writeable and not exceptable: # Timeout
-            rudics.timedOut()
+        nowNs = monotonic_ns() # One clock read per pass, shared by both sides
+        rTick(nowNs)
+        sTick(nowNs)
+        rEnsureOpen() # Once per tick, the fileno accessors never connect
+        ifpSerial = sInput()
+        ofpSerial = sOutput()
+        ifpRUDICS = rInput()
+        ofpRUDICS = rOutput()
+
+        if fps != (ifpSerial, ofpSerial, ifpRUDICS, ofpRUDICS): # Only touch sel on a change
+            fps = (ifpSerial, ofpSerial, ifpRUDICS, ofpRUDICS)
+            reselect(sel, registered, (
+                (ifpSerial, READ, serialHandlers),
+                (ofpSerial, WRITE, serialHandlers),
+                (ifpRUDICS, READ, rudicsHandlers),
+                (ofpRUDICS, WRITE, rudicsHandlers)))
+
+        now = nowNs / 1e9 # The seconds rudics.tick derived, without the attribute lookups
+        timeout = max(0, rudics.deadline - now) # Cached, only recomputed on activity
+        dt = sTimeout() # Wake up to flush bytes held for the serial port
+        if (dt is not None) and (dt < timeout):
+            timeout = dt
+        if tLogFlush is not None: # Write the binary log out at most a second behind
+            if now >= tLogFlush:
+                ofp.flush()
+                tLogFlush = None
+            elif (tLogFlush - now) < timeout:
+                timeout = tLogFlush - now
+        # logging.info('timeout=%s fps=%s s %s r %s', 
+                # timeout, fps, serial.nBuffer, rudics.nBuffer)
+        events = select(timeout) # Errors and hangups are reported as readable and writeable
+        nowNs = monotonic_ns() # select may have waited
+        rTick(nowNs)
+        sTick(nowNs)
+
+        if not events: # Timeout
+            rTimedOut()
             continue
 
-        for fp in exceptable: # Handle exceptions first
-            # logging.info('exceptable fp=%s', fp)
-            if fp == ifpSerial:
-                logging.warning('Select exception for serial connection')
-                serial.close() # Exception on the serial side
-            else: # exception on the RUDICS side
-                logging.warning('Select exception for RUDICS connection')
-                rudics.close()
-
-        if exceptable: continue # Skip reading/writing this time if there are exceptions
-
-        for fp in writeable:
-            if fp == ofpSerial:
-                serial.send()
-            else: # RUDICS
-                rudics.send()
-
-
-        for fp in readable:
-            if fp == ifpSerial:
-                n = serial.nAvailable() # How many characters are available
-                c = serial.get(n) # Read a character
-                if len(c): 
-                    rudics.put(c)
-                    if ofp: ofp.write(bytes(f"SERIAL {len(c)} : ", "UTF-8") + c + b'\n')
-                else: # EOF
-                    serial.close()
-            else: # RUDICS
-                c = rudics.get(1024 * 1024) # Read what is available up to 1MB
-                if len(c):
-                    serial.put(c)
-                    if ofp: ofp.write(bytes(f"RUDICS {len(c)} : ", "UTF-8") + c + b'\n')
-                else: # EOF
-                    rudics.close()
+        for (key, mask) in events: # Writes first
+            if mask & WRITE:
+                key.data[1]() # send
+
+        for (key, mask) in events:
+            if mask & READ:
+                key.data[0]() # readable
 
+    sel.close()
     if ofp: ofp.close()
 
 parser = argparse.ArgumentParser(description="Simulate a RUIDCS connection for a Slocum simulator")